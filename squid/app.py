@@ -3,6 +3,10 @@
 Author: Finlay Clark  
 Created: 2024
 """
+import asyncio
+import threading
+import time
+
 import py_cui
 
 from .slurm import SlurmQueue, NAMES_TO_JOB_ATTRIBUTES, SlurmJob
@@ -10,7 +14,7 @@ from .logo import LOGO
 
 from . import app_layout
 
-# Create a fake job to use as a banner
+# Create a fake job to use as a banner of column names
 slurm_banner_fake_job = SlurmJob(
     job_id="Job ID",
     name="Name",
@@ -25,12 +29,34 @@ slurm_banner_fake_job = SlurmJob(
     array_task_id="Ar.T.Id",
 )
 
+# How often (in seconds) the display checks for results from the background
+# event loop. py_cui only supports a fixed refresh timeout, which also sets
+# how often the display is redrawn when idle, so keep this modest.
+POLL_INTERVAL = 0.05
+
+# Minimum time (in seconds) between queue updates, measured from when the last
+# update started or, if it took longer, finished. Requests for updates made
+# sooner than this, or while an update is running, are coalesced into a single
+# deferred update.
+REFRESH_DEBOUNCE = 0.25
+
 
 class SquidApp:
     """Main application class for squid"""
 
-    def __init__(self, master: py_cui.PyCUI):
+    def __init__(self, master: py_cui.PyCUI, loop: asyncio.AbstractEventLoop):
         self.master = master
+        # Event loop, running on a background thread, used to talk to slurm
+        # without blocking the display.
+        self.loop = loop
+        self._pending_update = None
+        self._refresh_pending = False
+        # When the last update started or finished, for debouncing updates
+        self._last_refresh = float("-inf")
+        # Rows currently shown in the job display
+        self._last_rows = []
+        # Height of the column names' cell when they were last aligned
+        self._banner_height = None
         self.slurm_queue = SlurmQueue()
         self.job_filter_attribute = "name"
         self.job_filter_regex = ""
@@ -42,6 +68,15 @@ class SquidApp:
 
     def create_display_objects(self):
         """Create the display objects, without adding functionality or setting colors"""
+        # Indent the column names to line up with the bordered job display
+        self.job_attr_banner = self.master.add_block_label(
+            f"  {slurm_banner_fake_job}",
+            app_layout.JOB_ATTR_BANNER_ROW,
+            app_layout.JOB_ATTR_BANNER_COL,
+            app_layout.JOB_ATTR_BANNER_ROW_SPAN,
+            app_layout.JOB_ATTR_BANNER_COL_SPAN,
+            center=False,
+        )
         self.job_display = self.master.add_scroll_menu(
             "Selected Jobs",
             app_layout.JOB_DISPLAY_ROW,
@@ -104,7 +139,7 @@ class SquidApp:
         )
 
         # Store lists of the objects by type.
-        self.labels = [self.logo]
+        self.labels = [self.logo, self.job_attr_banner]
         self.buttons = [
             self.kill_all_button,
             self.hold_all_button,
@@ -164,46 +199,126 @@ class SquidApp:
             py_cui.keys.KEY_ENTER, self.set_filter_regex
         )
 
+        # Check for finished queue updates every time the display is drawn
+        self.master.set_refresh_timeout(POLL_INTERVAL)
+        self.master.set_on_draw_update_func(self.on_draw)
+
+    def on_draw(self):
+        """Called every time the display is drawn"""
+        self.align_banner()
+        self.check_pending_update()
+
+    def align_banner(self):
+        """Keep the column names on the bottom line of their cell, just above the job display"""
+        height, _ = self.job_attr_banner.get_absolute_dimensions()
+        if height != self._banner_height:
+            self._banner_height = height
+            self.job_attr_banner.set_title(
+                "\n" * max(height - 1, 0) + f"  {slurm_banner_fake_job}"
+            )
+
     def update_jobs(self):
         """Update the job display"""
-        self.job_display.clear()
-        self.slurm_queue.update(self.job_filter_attribute, self.job_filter_regex)
-        self.job_display.add_item(slurm_banner_fake_job)
-        for job in self.slurm_queue.jobs:
-            self.job_display.add_item(job)
+        now = time.monotonic()
+        if self._pending_update is not None or now - self._last_refresh < REFRESH_DEBOUNCE:
+            # Updating now or very recently, so leave this to check_pending_update.
+            # Only one update runs at a time, so an older update can't finish
+            # last and overwrite the queue with stale jobs.
+            self._refresh_pending = True
+            return
+        self._last_refresh = now
+        self._refresh_pending = False
+        self._pending_update = asyncio.run_coroutine_threadsafe(
+            self.slurm_queue.update_async(
+                self.job_filter_attribute, self.job_filter_regex
+            ),
+            self.loop,
+        )
+
+    def check_pending_update(self):
+        """Refresh the job display if an update has finished, and start any deferred update"""
+        if self._pending_update is not None and self._pending_update.done():
+            update, self._pending_update = self._pending_update, None
+            # Start the debounce window again, so that a burst of requests made
+            # during a slow update leads to one update rather than back-to-back ones
+            self._last_refresh = time.monotonic()
+            # Re-raise any error from the update on the main thread
+            update.result()
+            self.refresh_job_display()
+        if (
+            self._refresh_pending
+            and time.monotonic() - self._last_refresh >= REFRESH_DEBOUNCE
+        ):
+            self.update_jobs()
+
+    def refresh_job_display(self):
+        """Update the job display to match the queue, skipping it if nothing has changed"""
+        jobs = self.slurm_queue.jobs
+        rows = [str(job) for job in jobs]
+        if rows == self._last_rows:
+            return
+
+        selected = self.job_display.get()
+        # Rebuild the live item list in place, in squeue's order
+        items = self.job_display.get_item_list()
+        items[:] = jobs
+        # Keep the same job selected if it is still in the queue
+        index = min(self.job_display.get_selected_item_index(), len(items) - 1)
+        if selected is not None:
+            index = next(
+                (i for i, job in enumerate(items) if job.job_id == selected.job_id),
+                index,
+            )
+        index = max(index, 0)
+        self.job_display.set_selected_item_index(index)
+        # Unlike clear(), rebuilding doesn't reset the scroll position, so keep
+        # the selected job in view and don't scroll past the end of the list.
+        # The viewport shows rows _top_view to _top_view + viewport height.
+        viewport_height = self.job_display.get_viewport_height()
+        top_view = min(self.job_display._top_view, index)
+        top_view = max(top_view, index - viewport_height)
+        top_view = min(top_view, len(items) - viewport_height - 1)
+        self.job_display._top_view = max(top_view, 0)
+        self._last_rows = rows
+
+    def _run_action(self, action, jobs):
+        """Start a queue action, and request an update"""
+        # The action only starts the slurm command, and the next queue update
+        # waits for it, so this doesn't block the display.
+        action(jobs)
+        self.update_jobs()
+
+    def _selected_jobs(self):
+        """Get the selected job as a list, which is empty if there are no jobs"""
+        job = self.job_display.get()
+        return [] if job is None else [job]
 
     def kill_job(self):
         """Kill selected job"""
-        self.slurm_queue.kill_job(self.job_display.get())
-        self.update_jobs()
+        self._run_action(self.slurm_queue.kill_jobs, self._selected_jobs())
 
     def hold_job(self):
         """Hold selected job"""
-        self.slurm_queue.hold_job(self.job_display.get())
-        self.update_jobs()
+        self._run_action(self.slurm_queue.hold_jobs, self._selected_jobs())
 
     def release_job(self):
         """Release selected job"""
-        self.slurm_queue.release_job(self.job_display.get())
-        self.update_jobs()
+        self._run_action(self.slurm_queue.release_jobs, self._selected_jobs())
 
     def kill_all_jobs(self):
         """Kill all jobs"""
-        for job in self.slurm_queue.jobs:
-            self.slurm_queue.kill_job(job)
-        self.update_jobs()
+        jobs = list(self.job_display.get_item_list())
+        self._run_action(self.slurm_queue.kill_jobs, jobs)
 
     def hold_all_jobs(self):
         """Hold all jobs"""
-        for job in self.slurm_queue.jobs:
-            self.slurm_queue.hold_job(job)
-        self.update_jobs()
+        jobs = list(self.job_display.get_item_list())
+        self._run_action(self.slurm_queue.hold_jobs, jobs)
 
     def release_all_jobs(self):
         """Release all jobs"""
-        for job in self.slurm_queue.jobs:
-            self.slurm_queue.release_job(job)
-        self.update_jobs()
+        jobs = list(self.job_display.get_item_list())
+        self._run_action(self.slurm_queue.release_jobs, jobs)
 
     def set_filter_attribute(self):
         """Set the filter attribute"""
@@ -231,6 +346,11 @@ def main():
     root.set_status_bar_text(
         "   q: Quit || Arrow Keys: Navigate widgets || Enter: Focus on widget || Mouse click: Press button"
     )
-    s = SquidApp(root)
+    # Run slurm commands on an event loop in a background thread so that
+    # the display stays responsive while waiting for them.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    s = SquidApp(root, loop)
     s.update_jobs()
     root.start()
+    loop.call_soon_threadsafe(loop.stop)
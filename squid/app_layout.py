@@ -5,7 +5,7 @@ NUM_COLS = 6
 
 LOGO_ROW = 0
 LOGO_COL = 0
-LOGO_ROW_SPAN = 2
+LOGO_ROW_SPAN = 1
 LOGO_COL_SPAN = 6
 
 JOB_ATTR_BANNER_ROW = 1
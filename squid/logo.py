@@ -1,6 +1,4 @@
-LOGO = """
-
-══════════════════════
+LOGO = """══════════════════════
 ╔═╗  ╔═╗   ╦ ╦  ╦  ╔╦╗
 ╚═╗  ║═╬╗  ║ ║  ║   ║║
 ╚═╝  ╚═╝╚  ╚═╝  ╩  ═╩╝
@@ -1,12 +1,50 @@
 """Functionality for interacting with the slurm queue."""
 
-from dataclasses import dataclass
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+import functools
+import operator
 import subprocess
 import os
+import pwd
 import re
-from typing import List
+import time
+from typing import List, Optional
 from ._errors import SlurmQueueReadError
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+# The user whose jobs are displayed. Looked up once rather than on every update.
+# Unlike os.getlogin(), this doesn't need a controlling terminal, so also works
+# in detached tmux/screen sessions.
+_USER = pwd.getpwuid(os.geteuid()).pw_name
+
+# A row of squeue's delimited text output. Job names are the only free-form
+# field, so let them contain the delimiter.
+_TEXT_ROW_RE = re.compile(
+    r"(?P<job_id>[^|]*)\|(?P<name>.*)\|(?P<partition>[^|]*)\|(?P<time_used>[^|]*)\|"
+    r"(?P<submit_time>[^|]*)\|(?P<start_time>[^|]*)\|(?P<end_time>[^|]*)\|(?P<state>[^|]*)\|"
+    r"(?P<array_job_id>[^|]*)\|(?P<array_task_id>[^|]*)\|(?P<node_list>[^|]*)\|(?P<reason>[^|]*)"
+)
+
+# Ids of jobs that slurm can act on, including array tasks such as 1234_5.
+_JOB_ID_RE = re.compile(r"\d+(?:_\d+)?")
+
+# Errors from squeue --json meaning that it doesn't support JSON output, either
+# because it doesn't know the option or has no plugin to produce it.
+_JSON_UNSUPPORTED_RE = re.compile(
+    rb"unrecognized option|invalid option|unknown option|json|data_parser|openapi|serializer",
+    re.IGNORECASE,
+)
+
+# Slurm's NO_VAL sentinel. Older versions use this (and INFINITE, which
+# is larger) in place of the {"set": false} wrapper for unset numbers.
+_NO_VAL = 0xFFFFFFFE
+
 # Mapping between display names and slurm attribute names
 NAMES_TO_JOB_ATTRIBUTES = {
     "Name": "name",
@@ -22,8 +60,20 @@ NAMES_TO_JOB_ATTRIBUTES = {
     "Array Task Id": "array_task_id",
 }
 
+# Column layout of a job in the job display
+_ROW_FORMAT = "{:<10}{:<20}{:<25}{:<10}{:<15}{:<15}{:<15}{:<11}{:<16}{:<10}{:<10}".format
 
-@dataclass
+# Filter regexes which match every job, so needn't be applied
+_MATCH_ALL = ("", ".*", ".+")
+
+
+@functools.lru_cache(maxsize=32)
+def _compiled(pattern: str) -> re.Pattern:
+    """Compile a regex, memoized so repeated updates reuse the same pattern."""
+    return re.compile(pattern)
+
+
+@dataclass(slots=True, frozen=True)
 class SlurmJob:
     """Dataclass to hold information about a slurm job."""
 
@@ -38,15 +88,152 @@ class SlurmJob:
     array_job_id: str
     array_task_id: str
     node_list: str
+    # The formatted row, computed once as it is drawn on every display refresh.
+    _row: str = field(init=False, repr=False, compare=False)
 
-    def __str__(self):
+    def __post_init__(self):
         """Format nicely into columns."""
         # Remove the year part of the times to save space
         times = [
-            time.split("-")[-1]
-            for time in [self.submit_time, self.start_time, self.end_time]
+            timestamp.rsplit("-", 1)[-1]
+            for timestamp in (self.submit_time, self.start_time, self.end_time)
         ]
-        return f"{self.job_id:<10}{self.name:<20}{self.partition:<25}{self.time_used:<10}{times[0]:<15}{times[1]:<15}{times[2]:<15}{self.state:<11}{self.node_list:<16}{self.array_job_id:<10}{self.array_task_id:<10}"
+        row = _ROW_FORMAT(
+            self.job_id,
+            self.name,
+            self.partition,
+            self.time_used,
+            *times,
+            self.state,
+            self.node_list,
+            self.array_job_id,
+            self.array_task_id,
+        )
+        object.__setattr__(self, "_row", row)
+
+    def __str__(self):
+        return self._row
+
+
+async def _run(*args: str) -> bytes:
+    """Run a command without blocking the event loop and return its stdout."""
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+    return stdout
+
+
+async def _run_lines(*args: str):
+    """Run a command without blocking the event loop, yielding its stdout line by line."""
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        async for line in proc.stdout:
+            yield line.decode("utf-8")
+        stderr = await proc.stderr.read()
+        if await proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr)
+    finally:
+        # Don't leave squeue running if we stop reading part way through
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+
+def _job_ids(jobs: List[SlurmJob]) -> List[str]:
+    """Get the ids of the jobs which slurm can act on."""
+    # Only pass slurm ids it understands, so that a missing or malformed id
+    # can't be taken as an option or cancel the wrong job
+    return [job.job_id for job in jobs if _JOB_ID_RE.fullmatch(job.job_id)]
+
+
+def _json_number(value) -> Optional[int]:
+    """Unwrap a number from squeue's JSON output, returning None if it is unset.
+
+    Newer Slurm versions wrap numbers as {"set": ..., "infinite": ..., "number": ...},
+    whereas older versions give the number directly.
+    """
+    if isinstance(value, dict):
+        if not value.get("set", True) or value.get("infinite", False):
+            return None
+        value = value.get("number")
+    if value is None or value >= _NO_VAL:
+        return None
+    return value
+
+
+def _format_timestamp(timestamp: Optional[int]) -> str:
+    """Format a unix timestamp in the same way as squeue's text output."""
+    if not timestamp:
+        return "N/A"
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp))
+
+
+def _format_duration(seconds: int) -> str:
+    """Format a duration in the same way as squeue's TimeUsed column."""
+    minutes, seconds = divmod(max(seconds, 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}-{hours:02}:{minutes:02}:{seconds:02}"
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
+
+def _job_from_json(record: dict) -> SlurmJob:
+    """Create a SlurmJob from a single job record of squeue's JSON output."""
+    job_id = str(record["job_id"])
+    state = record.get("job_state", "")
+    if isinstance(state, list):
+        state = ",".join(state)
+    submit_time = _json_number(record.get("submit_time"))
+    start_time = _json_number(record.get("start_time"))
+    end_time = _json_number(record.get("end_time"))
+
+    # The JSON output has no equivalent of the TimeUsed column, so work it out.
+    now = int(time.time())
+    time_used = 0
+    if start_time and start_time <= now:
+        time_used = (min(end_time, now) if end_time else now) - start_time
+
+    array_job_id = _json_number(record.get("array_job_id"))
+    array_task_id = _json_number(record.get("array_task_id"))
+    if array_task_id is None:
+        # Pending array jobs are a single record covering many tasks.
+        array_task_id = record.get("array_task_string") or "N/A"
+
+    return SlurmJob(
+        job_id=job_id,
+        name=record.get("name", ""),
+        partition=record.get("partition", ""),
+        time_used=_format_duration(time_used),
+        submit_time=_format_timestamp(submit_time),
+        start_time=_format_timestamp(start_time),
+        end_time=_format_timestamp(end_time),
+        state=state,
+        array_job_id=str(array_job_id) if array_job_id else job_id,
+        array_task_id=str(array_task_id),
+        # As for the text output, show the reason if the job has no nodes.
+        node_list=record.get("nodes") or record.get("state_reason", ""),
+    )
+
+
+def _parse_squeue_json(queue_info: bytes) -> List[SlurmJob]:
+    """Parse the JSON output of squeue into jobs."""
+    try:
+        records = _json.loads(queue_info)["jobs"]
+        # Some Slurm versions ignore filtering arguments when dumping JSON,
+        # so make sure we only show the user's own jobs.
+        return [_job_from_json(r) for r in records if r.get("user_name", _USER) == _USER]
+    except (ValueError, KeyError, TypeError) as e:
+        raise SlurmQueueReadError(
+            "Error reading slurm queue. Could not parse the JSON output of squeue."
+        ) from e
 
 
 class SlurmQueue:
@@ -54,78 +241,127 @@ class SlurmQueue:
 
     def __init__(self):
         self.jobs = []
-        self.update()
+        self._json_supported = True
+        # scancel/scontrol processes which have been started but not yet reaped
+        self._pending = []
 
     def update(self, job_filter_attribute: str = "", job_filter_regex: str = ""):
+        """Update the queue information, blocking until squeue returns."""
+        asyncio.run(self.update_async(job_filter_attribute, job_filter_regex))
+
+    async def update_async(
+        self, job_filter_attribute: str = "", job_filter_regex: str = ""
+    ):
         """Update the queue information."""
-        self.jobs = []
-        # Get the queue information
-        queue_info = subprocess.check_output(
-            [
-                "squeue",
-                "-u",
-                f"{os.getlogin()}",
-                # "chenfeng",
-                "--noheader",
-                "--array",
-                "--Format",
-                # Make sure output is well-spaced to prevent issues with parsing.
-                "JobID:1000,Name:1000,Partition:1000,TimeUsed:1000,SubmitTime:1000,StartTime:1000,EndTime:1000,State:1000,ArrayJobID:1000,ArrayTaskID:1000,NodeList:1000,Reason:1000",
-            ]
-        ).decode("utf-8")
-        # Split into lines and parse into jobs. Note quirk that if a job has no node list, the node list column is missing.
-        for line in queue_info.split("\n"):
-            if line:
-                job_info = line.split()
-                # Check that the line is the correct length
-                if len(job_info) == 12:
-                    # We have both nodelist and reason, so remove the reason and display only nodelist.
-                    job_info.pop(11)
-                if len(job_info) > 12:
-                    # Maybe we have the long message "Nodes required for job are DOWN..."
-                    # We want to remove the reason and replace with req. nodes not avail.
-                    job_info = job_info[:10]
-                    job_info.append("Nodes N. Avail.")
-                if len(job_info) != 11:
-                    breakpoint()
+        # Make sure squeue reflects any actions we've just taken
+        await self._reap()
+        jobs = None
+        if self._json_supported:
+            try:
+                jobs = await self._read_json()
+            except subprocess.CalledProcessError as e:
+                # Other errors, e.g. controller timeouts, may well be transient,
+                # so only give up on JSON if it's unsupported.
+                if not _JSON_UNSUPPORTED_RE.search(e.stderr or b""):
+                    raise
+                # squeue is too old or was built without a JSON data parser,
+                # so fall back to the text output from now on.
+                self._json_supported = False
+        if jobs is None:
+            jobs = await self._read_text()
+
+        # Filter jobs
+        self.jobs = self.filter_jobs(jobs, job_filter_attribute, job_filter_regex)
+
+    async def _read_json(self) -> List[SlurmJob]:
+        """Read the queue using squeue's structured JSON output."""
+        queue_info = await _run("squeue", "--json", "-u", _USER, "--array")
+        # Parsing a large queue takes a while, so keep it off the event loop
+        return await asyncio.to_thread(_parse_squeue_json, queue_info)
+
+    async def _read_text(self) -> List[SlurmJob]:
+        """Read the queue using squeue's delimited text output."""
+        jobs = []
+        queue_info = _run_lines(
+            "squeue",
+            "-u",
+            _USER,
+            "--noheader",
+            "--array",
+            "--format",
+            # Fields without a size are printed unpadded, so separate them with
+            # a delimiter. Order matches SlurmJob, followed by the reason.
+            "%A|%j|%P|%M|%V|%S|%e|%T|%F|%K|%N|%r",
+        )
+        async with contextlib.aclosing(queue_info) as lines:
+            async for line in lines:
+                if not line.strip():
+                    continue
+                match = _TEXT_ROW_RE.fullmatch(line.rstrip("\n"))
+                if match is None:
                     raise SlurmQueueReadError(
                         "Error reading slurm queue. Please check your for any irregularities in squeue output."
                     )
-                self.jobs.append(SlurmJob(*job_info))
-
-        # Filter jobs
-        self.jobs = self.filter_jobs(self.jobs, job_filter_attribute, job_filter_regex)
+                # Groups are in the same order as the SlurmJob fields. Show the
+                # reason in place of the node list if the job has no nodes.
+                job_info = match.groups()
+                jobs.append(SlurmJob(*job_info[:10], job_info[10] or job_info[11]))
+        return jobs
 
     def filter_jobs(self, jobs: List[SlurmJob], attribute: str = "", regex: str = ""):
         """Filter jobs by attribute and regex."""
-        filtered_jobs = []
-        # If empty attribute or regex, return all jobs
-        if not attribute or not regex:
+        # If empty attribute or a regex which matches everything, return all jobs
+        if not attribute or regex in _MATCH_ALL:
             return jobs
-        # Filter jobs
-        for job in jobs:
-            attr = getattr(job, attribute)
-            # Use regex to filter
-            if attr and re.search(regex, attr):
-                filtered_jobs.append(job)
-        return filtered_jobs
+        # Filter jobs, looking up the attribute and compiling the regex once rather than once per job
+        getter = operator.attrgetter(attribute)
+        search = _compiled(regex).search
+        return [job for job in jobs if (attr := getter(job)) and search(attr)]
+
+    def _start(self, *args: str):
+        """Start a slurm command without waiting for it to finish."""
+        self._pending.append(
+            subprocess.Popen(
+                args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        )
+
+    async def _reap(self):
+        """Wait for any slurm commands started since the last update."""
+        pending, self._pending = self._pending, []
+        for proc in pending:
+            if proc.poll() is None:
+                await asyncio.to_thread(proc.wait)
 
     def kill_job(self, job: SlurmJob):
         """Kill a job."""
-        # Only killing if job id is a number allows us to use the fake job
-        # to display the column names
-        if job.job_id.isdigit():
-            subprocess.run(["scancel", job.job_id])
+        self.kill_jobs([job])
 
     def hold_job(self, job: SlurmJob):
         """Hold a job."""
-        if job.job_id.isdigit():
-            subprocess.run(["scontrol", "hold", job.job_id])
+        self.hold_jobs([job])
 
     def release_job(self, job: SlurmJob):
         """Release a job."""
-        if job.job_id.isdigit():
-            subprocess.run(["scontrol", "release", job.job_id])
+        self.release_jobs([job])
+
+    def kill_jobs(self, jobs: List[SlurmJob]):
+        """Kill several jobs with a single call to scancel."""
+        job_ids = _job_ids(jobs)
+        if job_ids:
+            self._start("scancel", *job_ids)
+
+    def hold_jobs(self, jobs: List[SlurmJob]):
+        """Hold several jobs with a single call to scontrol."""
+        job_ids = _job_ids(jobs)
+        if job_ids:
+            self._start("scontrol", "hold", ",".join(job_ids))
+
+    def release_jobs(self, jobs: List[SlurmJob]):
+        """Release several jobs with a single call to scontrol."""
+        job_ids = _job_ids(jobs)
+        if job_ids:
+            self._start("scontrol", "release", ",".join(job_ids))
 
     def __getitem__(self, index):
         return self.jobs[index]